@@ -1,48 +1,430 @@
 import argparse
+import contextlib
+import copy
+import multiprocessing
+import os
+import threading
+from collections.abc import Iterable, Mapping
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from warnings import warn
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, FineGrainedFP8Config
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+from transformers.utils import is_flash_attn_2_available
 try:
-    from transformers.pipelines import pipeline
-    from transformers import TextGenerationPipeline
-except Exception:
-    from transformers import pipeline, TextGenerationPipeline
+    from vllm import LLM
+except ImportError:
+    # vLLM необязателен: без него используется модель transformers
+    LLM = None
 
 
+# Системный промпт одинаков для всех запросов, поэтому его KV-кэш вычисляется один раз
+SYSTEM_PROMPT = 'Твоя задача — перефразировать в указанном стиле текст, который присылает пользователь. Не добавляй ничего от себя, даже кавычки.'
+# Неизменные части промпта собираются один раз, для каждой строки подставляются только текст и стиль
+SYSTEM_MESSAGE = {'role': 'system', 'content': SYSTEM_PROMPT}
+USER_PROMPT = 'Текст: "%s"\nСтиль: %s'
+# Поддерживаемые способы квантования весов модели.
+# 'awq' требует уже квантованного AWQ-чекпоинта в качестве модели.
+QUANTIZATION_METHODS = ('int8', 'fp8', 'awq')
+# Размер батча для модели transformers (vLLM формирует батчи сам)
+BATCH_SIZE = 16
+# Буфер записи результата: данные сбрасываются на диск блоками по 1 МБ
+WRITE_BUFFER_SIZE = 1 << 20
 
 
+class TextEngine:
+    """
+    Тонкая обёртка над движком генерации текста.
+
+    Если установлена библиотека vLLM, генерация выполняется через `vllm.LLM`
+    (PagedAttention и непрерывный батчинг), иначе - через модель transformers.
+
+    Attributes:
+        tokenizer: Токенизатор модели.
+        llm (LLM|None): Движок vLLM.
+        model (PreTrainedModel|None): Модель transformers.
+        system_prompt (str|None): Текст закэшированного системного промпта.
+        system_ids (list[int]|None): Токены системного промпта.
+        system_kv (tuple|None): Токены системного промпта и их KV-кэш (только для transformers).
+    """
+
+    def __init__(self, tokenizer, llm=None, model=None):
+        self.tokenizer = tokenizer
+        self.llm = llm
+        self.model = model
+        self.system_prompt = None
+        self.system_ids = None
+        self.system_kv = None
+
+    def cache_system_prompt(self, system_prompt:str):
+        """
+        Один раз токенизирует системный промпт и вычисляет его KV-кэш.
+
+        vLLM переиспользует общие префиксы сам (enable_prefix_caching),
+        поэтому KV-кэш вычисляется только для модели transformers.
+
+        Args:
+            system_prompt (str): Текст системного промпта.
+        """
+        system = [{'role': 'system', 'content': system_prompt}]
+        # return_dict=False: токены нужны списком, чтобы их можно было склеивать и сравнивать
+        # (новые версии transformers по умолчанию возвращают BatchEncoding)
+        system_ids = self.tokenizer.apply_chat_template(system, add_generation_prompt=False, return_dict=False)
+        # Готовые токены можно приклеивать к отдельно закодированной реплике пользователя,
+        # только если шаблон модели кодирует реплики независимо друг от друга (проверяется на пробной реплике)
+        probe = [{'role': 'user', 'content': '.'}]
+        full_ids = self.tokenizer.apply_chat_template(system + probe, add_generation_prompt=True, return_dict=False)
+        if full_ids != system_ids + self.tokenizer.apply_chat_template(probe, add_generation_prompt=True, return_dict=False):
+            return
+        self.system_prompt = system_prompt
+        self.system_ids = system_ids
+
+        if self.model is None:
+            return
+        model = self.model
+        system_ids = torch.tensor([system_ids], device=model.device)
+        with torch.no_grad():
+            cache = model(system_ids, use_cache=True).past_key_values
+        self.system_kv = (system_ids, cache)
+
+    def _encode(self, message:list[dict]) -> list[int]:
+        # Токены системного промпта берутся готовыми, кодируется только остаток диалога
+        if self.system_ids is not None and message[0] == {'role': 'system', 'content': self.system_prompt}:
+            return self.system_ids + self.tokenizer.apply_chat_template(message[1:], add_generation_prompt=True, return_dict=False)
+        return self.tokenizer.apply_chat_template(message, add_generation_prompt=True, return_dict=False)
+
+    def _prepare_single(self, message:list[dict]) -> dict:
+        # Аргументы generate для одного диалога с переиспользованием KV-кэша системного промпта
+        input_ids = torch.tensor([self._encode(message)], device=self.model.device)
+        kwargs = {
+            'input_ids': input_ids,
+            'attention_mask': torch.ones_like(input_ids),
+            'pad_token_id': self.tokenizer.pad_token_id
+        }
+        if self.system_kv is not None:
+            system_ids, cache = self.system_kv
+            n = system_ids.shape[1]
+            # Кэш применим, только если запрос начинается с тех же токенов
+            if input_ids.shape[1] > n and torch.equal(input_ids[:, :n], system_ids):
+                # generate дописывает кэш, поэтому каждому запросу нужна своя копия
+                kwargs['past_key_values'] = copy.deepcopy(cache)
+        return kwargs
+
+    def _limits(self, prompt_length:int, token_limit:int|None, min_tokens:int|None, stop_when, finish_when) -> dict:
+        # Ограничения длины ответа в формате аргументов generate
+        kwargs = {'max_new_tokens': token_limit}
+        if min_tokens is not None:
+            kwargs['min_new_tokens'] = min_tokens
+        if stop_when is not None:
+            kwargs['stopping_criteria'] = StoppingCriteriaList([_TextStopCriteria(self.tokenizer, prompt_length, stop_when)])
+        if finish_when is not None:
+            eos = self.model.generation_config.eos_token_id
+            if eos is None:
+                eos = self.tokenizer.eos_token_id
+            eos = [eos] if isinstance(eos, int) else list(eos)
+            kwargs['logits_processor'] = LogitsProcessorList([_TextEosProcessor(self.tokenizer, prompt_length, finish_when, eos)])
+        return kwargs
+
+    def _generate_single(self, message:list[dict], token_limit:int|None, min_tokens:int|None=None, stop_when=None, finish_when=None) -> str:
+        kwargs = self._prepare_single(message)
+        n = kwargs['input_ids'].shape[1]
+        out = self.model.generate(**self._limits(n, token_limit, min_tokens, stop_when, finish_when), **kwargs)
+        return self.tokenizer.decode(out[0, n:], skip_special_tokens=True)
+
+    def _generate_batch(self, input_ids:list[list[int]], token_limit:int|None, min_tokens:int|None=None, stop_when=None, finish_when=None) -> list[str]:
+        # Батч обрабатывается одним вызовом generate.
+        # Левый padding (padding_side='left') выравнивает концы промптов, поэтому
+        # новые токены каждой строки начинаются с одной и той же позиции.
+        model = self.model
+        enc = self.tokenizer.pad(
+            {'input_ids': input_ids},
+            padding=True,
+            return_tensors='pt'
+        ).to(model.device)
+        n = enc.input_ids.shape[1]
+        out = model.generate(
+            **enc,
+            **self._limits(n, token_limit, min_tokens, stop_when, finish_when),
+            use_cache=True,
+            pad_token_id=self.tokenizer.pad_token_id
+        )
+        return self.tokenizer.batch_decode(out[:, n:], skip_special_tokens=True)
+
+    def generate(self, messages:list[list[dict]], token_limit:int|None=None, min_tokens:int|None=None, stop_when=None, finish_when=None) -> list[str]:
+        """
+        Генерирует ответы модели для списка диалогов.
+
+        Args:
+            messages (list[list[dict]]): Список диалогов в формате chat template.
+            token_limit (int|None): Ограничение на количество выходных токенов модели.
+            min_tokens (int|None): Минимальное количество выходных токенов модели.
+            stop_when (Callable[[str], bool]|None): Условие досрочной остановки, проверяемое
+                по уже сгенерированному тексту (только для transformers).
+            finish_when (Callable[[str], bool]|None): Условие, без выполнения которого модели
+                запрещено завершать ответ (только для transformers).
+
+        Returns:
+            list[str]: Ответы модели в порядке следования диалогов.
+        """
+        if self.llm is not None:
+            prompts = [ {'prompt_token_ids': self._encode(m)} for m in messages ]
+            # Параметры сэмплирования берутся из generation_config модели, как и в transformers.
+            # Размер батча не задаётся: vLLM сам формирует батчи из всех запросов.
+            params = self.llm.get_default_sampling_params()
+            params.max_tokens = token_limit
+            if min_tokens is not None:
+                params.min_tokens = min_tokens
+            outputs = self.llm.generate(prompts, params, use_tqdm=False)
+            return [ o.outputs[0].text for o in outputs ]
+
+        if len(messages) == 1 and self.system_kv is not None:
+            return [self._generate_single(messages[0], token_limit, min_tokens, stop_when, finish_when)]
+
+        # Запросы сортируются по длине и делятся на батчи из промптов близкой длины,
+        # чтобы на padding тратилось как можно меньше вычислений
+        encoded = [ self._encode(m) for m in messages ]
+        order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]))
+        answer = [None] * len(encoded)
+        for start in range(0, len(order), BATCH_SIZE):
+            chunk = order[start:start + BATCH_SIZE]
+            result = self._generate_batch([ encoded[i] for i in chunk ], token_limit, min_tokens, stop_when, finish_when)
+            for i, a in zip(chunk, result):
+                answer[i] = a
+        return answer
+
+    def generate_stream(self, message:list[dict], token_limit:int|None=None):
+        """
+        Генерирует ответ на один диалог, выдавая текст по мере появления токенов.
+
+        Если генератор закрывается досрочно (например, по Ctrl+C),
+        генерация останавливается на следующем токене.
+
+        Args:
+            message (list[dict]): Диалог в формате chat template.
+            token_limit (int|None): Ограничение на количество выходных токенов модели.
+
+        Yields:
+            str: Очередной фрагмент ответа.
+        """
+        if self.llm is not None:
+            # Офлайн-движок vLLM не выдаёт токены по частям, поэтому ответ выдаётся целиком
+            # (для потоковой генерации движок создаётся с text_pipeline_init(..., stream=True))
+            warn('Потоковая генерация недоступна с vLLM: ответ будет выведен целиком.')
+            yield self.generate([message], token_limit)[0]
+            return
+
+        abort = threading.Event()
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        kwargs = self._prepare_single(message)
+        errors = []
+
+        def run():
+            # Ошибка генерации (например, нехватка памяти CUDA) сохраняется для вызывающего потока,
+            # а streamer завершается в любом случае, иначе чтение из него зависнет
+            try:
+                self.model.generate(
+                    max_new_tokens=token_limit,
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList([_AbortCriteria(abort)]),
+                    **kwargs
+                )
+            except Exception as e:
+                errors.append(e)
+            finally:
+                streamer.end()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        try:
+            yield from streamer
+        finally:
+            abort.set()
+            thread.join()
+        if errors:
+            raise errors[0]
+
+
+class _AbortCriteria(StoppingCriteria):
+    # Останавливает генерацию, когда установлено событие abort
+    def __init__(self, abort:threading.Event):
+        self.abort = abort
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.abort.is_set(), dtype=torch.bool, device=input_ids.device)
 
-def text_pipeline_init(lm:str, padding:str):
+
+class _TextStopCriteria(StoppingCriteria):
+    # Останавливает генерацию строки, когда её новый текст удовлетворяет условию stop_when
+    def __init__(self, tokenizer, prompt_length:int, stop_when):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.stop_when = stop_when
+
+    def __call__(self, input_ids, scores, **kwargs):
+        texts = self.tokenizer.batch_decode(input_ids[:, self.prompt_length:], skip_special_tokens=True)
+        return torch.tensor([ self.stop_when(t) for t in texts ], dtype=torch.bool, device=input_ids.device)
+
+
+class _TextEosProcessor(LogitsProcessor):
+    # Запрещает токены конца ответа в строках, новый текст которых ещё не удовлетворяет условию finish_when
+    def __init__(self, tokenizer, prompt_length:int, finish_when, eos_token_ids:list[int]):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.finish_when = finish_when
+        self.eos_token_ids = eos_token_ids
+
+    def __call__(self, input_ids, scores):
+        texts = self.tokenizer.batch_decode(input_ids[:, self.prompt_length:], skip_special_tokens=True)
+        for row, t in enumerate(texts):
+            if not self.finish_when(t):
+                scores[row, self.eos_token_ids] = -float('inf')
+        return scores
+
+
+def _tensor_parallel_size(lm:str) -> int:
+    # vLLM делит головы внимания поровну между видеокартами, поэтому берётся
+    # наибольшее число видеокарт, на которое делится количество голов
+    config = AutoConfig.from_pretrained(lm)
+    heads = config.num_attention_heads
+    kv_heads = getattr(config, 'num_key_value_heads', None) or heads
+    size = max(torch.cuda.device_count(), 1)
+    while heads % size or (kv_heads % size and size % kv_heads):
+        size -= 1
+    return size
+
+
+def text_pipeline_init(lm:str, padding:str, quantization:str|None=None, stream:bool=False):
     """
-    Создаёт экземпляр пайплайна для генерации текста с заданной моделью и настройками.
+    Создаёт движок для генерации текста с заданной моделью и настройками.
 
     Args:
         lm (str): Имя или путь к языковой модели.
         padding (str): Тип выравнивания токенов ('left' или 'right').
+        quantization (str|None): Способ квантования весов (один из QUANTIZATION_METHODS).
+        stream (bool): Движок нужен для потоковой генерации (generate_stream).
+            Офлайн-движок vLLM не выдаёт токены по частям, поэтому в этом случае используется transformers.
 
     Returns:
-        TextGenerationPipeline: Инициализированный пайплайн для генерации текста.
+        TextEngine: Инициализированный движок для генерации текста.
+
+    Raises:
+        ValueError: Если указан неподдерживаемый способ квантования или
+            для 'awq' передан чекпоинт без AWQ-квантования.
     """
-    pipe = pipeline(
-        task="text-generation",
-        model=lm,
-        # Для автоматического подбора следующих параметров используется библиотека `accelerate`
-        device_map="auto",
-        dtype="auto"
-    )
-    # Левый padding нужен чтобы модель не теряла контекст при обработке списка
-    pipe.tokenizer.padding_side = padding
-    return pipe
-
-
-def inference(style:str, input:str|list[str], pipe: TextGenerationPipeline, token_limit:int|None=None, len_limit:int|None=None):
+    if quantization is not None and quantization not in QUANTIZATION_METHODS:
+        raise ValueError(f'Неподдерживаемый способ квантования: {quantization}.')
+    if quantization == 'awq':
+        # Веса AWQ квантуются заранее, поэтому конфигурация чекпоинта должна это указывать
+        quantization_config = getattr(AutoConfig.from_pretrained(lm), 'quantization_config', None)
+        if quantization_config is None or quantization_config.get('quant_method') != 'awq':
+            raise ValueError(f'Модель {lm} не является AWQ-чекпоинтом.')
+
+    # Запуск через torchrun --nproc_per_node=N: процессы уже распределены по видеокартам
+    distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+
+    # Квантование int8 выполняется библиотекой bitsandbytes, поэтому для него всегда используется transformers.
+    # Под torchrun каждый процесс создал бы свой движок vLLM на всех видеокартах, поэтому тоже transformers.
+    # Для потоковой генерации нужен TextIteratorStreamer, который есть только в transformers.
+    if LLM is not None and quantization != 'int8' and not distributed and not stream:
+        llm = LLM(
+            model=lm,
+            dtype="auto",
+            quantization=quantization,
+            # Тензорный параллелизм: каждая видеокарта участвует в каждом умножении матриц
+            tensor_parallel_size=_tensor_parallel_size(lm),
+            gpu_memory_utilization=0.9,
+            enable_prefix_caching=True
+        )
+        tokenizer = llm.get_tokenizer()
+        tokenizer.padding_side = padding
+        engine = TextEngine(tokenizer, llm=llm)
+    else:
+        model_kwargs = {}
+        if quantization == 'int8':
+            model_kwargs['quantization_config'] = BitsAndBytesConfig(load_in_8bit=True)
+        elif quantization == 'fp8':
+            model_kwargs['quantization_config'] = FineGrainedFP8Config()
+        # Для 'awq' параметры квантования читаются из конфигурации самого чекпоинта
+
+        # FlashAttention-2 требует пакета flash-attn и GPU Ampere или новее,
+        # иначе используется SDPA из PyTorch (vLLM выбирает ядра внимания сам)
+        # is_flash_attn_2_available проверяет только наличие пакета, поэтому архитектура GPU проверяется отдельно
+        flash_attn = is_flash_attn_2_available() and torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
+        model_kwargs['attn_implementation'] = "flash_attention_2" if flash_attn else "sdpa"
+
+        if distributed:
+            # Веса каждого слоя делятся между процессами torchrun
+            model_kwargs['tp_plan'] = "auto"
+        else:
+            # Для автоматического подбора размещения используется библиотека `accelerate`
+            model_kwargs['device_map'] = "auto"
+
+        model = AutoModelForCausalLM.from_pretrained(lm, dtype="auto", **model_kwargs)
+        tokenizer = AutoTokenizer.from_pretrained(lm)
+        # Левый padding нужен чтобы модель не теряла контекст при обработке списка
+        tokenizer.padding_side = padding
+        engine = TextEngine(tokenizer, model=model)
+
+    engine.cache_system_prompt(SYSTEM_PROMPT)
+
+    # forward модели transformers компилируется в ядра Inductor, компиляция происходит при прогреве.
+    # CUDA graphs (mode="reduce-overhead") не используются: DynamicCache и копии KV-кэша префикса
+    # меняют форму на каждом шаге, и графы пришлось бы перезаписывать.
+    # dynamic=True избавляет от перекомпиляции под каждую новую длину и размер батча.
+    # Квантованные слои bitsandbytes и FP8 torch.compile не поддерживают.
+    eager_forward = None
+    if engine.model is not None and torch.cuda.is_available() and quantization is None:
+        # Скомпилированные ядра сохраняются между запусками программы.
+        # Переменная задаётся только здесь, чтобы импорт модуля не менял окружение вызывающего кода.
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'torchinductor'))
+        eager_forward = engine.model.forward
+        engine.model.forward = torch.compile(eager_forward, fullgraph=False, dynamic=True)
+        # Перекомпиляция под новую форму входа может случиться и после прогрева, уже на запросе пользователя.
+        # Если она не удаётся, Dynamo выполняет этот фрагмент без компиляции, а не прерывает генерацию.
+        torch._dynamo.config.suppress_errors = True
+
+    # Пробная генерация: загрузка ядер CUDA, выделение памяти и компиляция
+    # происходят здесь, а не при первом запросе пользователя.
+    # Два новых токена затрагивают и prefill, и шаг декодирования,
+    # а два диалога разной длины - путь отдельного запроса и батча с padding.
+    warmup = [ [SYSTEM_MESSAGE, {'role': 'user', 'content': text}] for text in ('.', USER_PROMPT % ('.', '.')) ]
+    try:
+        engine.generate(warmup[:1], 2)
+        engine.generate(warmup, 2)
+    except Exception as e:
+        warn(f'Не удалось прогреть модель: {e}')
+        # Если прогрев не удался, модель продолжает работать без компиляции
+        if eager_forward is not None:
+            engine.model.forward = eager_forward
+    return engine
+
+
+def _iter_valid(input, len_limit:int|None):
+    # Один проход по входным строкам: пропуск пустых и нестроковых элементов,
+    # ошибка - сразу на первой слишком длинной строке
+    for ln in input:
+        if not isinstance(ln, str):
+            continue
+        ln = ln.strip()
+        if not ln:
+            continue
+        if len_limit is not None and len(ln) > len_limit:
+            raise ValueError('Длина одной из входных строк превышает максимально допустимый размер.')
+        yield ln
+
+
+def inference(style:str, input:str|Iterable[str], pipe: TextEngine, token_limit:int|None=None, len_limit:int|None=None, stream:bool=False):
     """
-    Перефразирует входной текст в указанном стиле с использованием заданного пайплайна.
+    Перефразирует входной текст в указанном стиле с использованием заданного движка.
 
     Args:
         style (str): Стиль, в котором необходимо перефразировать текст.
-        input (str | list[str]): Строка или список строк для обработки.
-        pipe (TextGenerationPipeline): Инициализированный пайплайн TextGenerationPipeline из библиотеки transformers.
+        input (str | Iterable[str]): Строка или последовательность строк (список, открытый файл и т.п.) для обработки.
+        pipe (TextEngine): Инициализированный движок, созданный функцией text_pipeline_init.
         token_limit (int|None): Ограничение на количество выходных токенов модели.
         len_limit (int|None): Максимальная длина одной входной строки.
+        stream (bool): Печатать ответ по мере генерации (только для одиночной строки).
 
     Returns:
         str|list[str]: Перефразированный текст или их список.
@@ -57,8 +439,8 @@ def inference(style:str, input:str|list[str], pipe: TextGenerationPipeline, toke
 
     if not isinstance(style, str):
         raise TypeError('Аргумент style должен иметь тип str.')
-    if not isinstance(pipe, TextGenerationPipeline):
-        raise TypeError('Аргумент pipe должен иметь тип TextGenerationPipeline.')
+    if not isinstance(pipe, TextEngine):
+        raise TypeError('Аргумент pipe должен иметь тип TextEngine.')
 
     # Разные алгоритмы для обработки одиночной строки и списка строк
 
@@ -69,44 +451,186 @@ def inference(style:str, input:str|list[str], pipe: TextGenerationPipeline, toke
         if len_limit is not None and len(input) > len_limit:
             raise ValueError('Длина входной строки превышает максимально допустимый размер.')
         message = [
-            {'role': 'system', 'content': f'Твоя задача — перефразировать в указанном стиле текст, который присылает пользователь. Не добавляй ничего от себя, даже кавычки.'},
-            {'role': 'user', 'content': f'Текст: "{input}"\nСтиль: {style}'}
+            SYSTEM_MESSAGE,
+            {'role': 'user', 'content': USER_PROMPT % (input, style)}
         ]
-        answer = pipe(message, max_new_tokens=token_limit)[0]['generated_text'][-1]['content']
+        if stream:
+            # Токены печатаются сразу, не дожидаясь окончания генерации
+            chunks = []
+            with contextlib.closing(pipe.generate_stream(message, token_limit)) as stream_chunks:
+                for chunk in stream_chunks:
+                    print(chunk, end='', flush=True)
+                    chunks.append(chunk)
+            answer = ''.join(chunks)
+        else:
+            answer = pipe.generate([message], token_limit)[0]
 
-    elif isinstance(input, list):
-        message = []
-        for ln in input:
-            if not isinstance(ln, str):
-                continue
-            else:
-                ln = ln.strip()
-                if ln == '':
-                    continue
-                elif len_limit is not None and len(ln) > len_limit:
-                    raise ValueError('Длина одной из входных строк превышает максимально допустимый размер.')
-                
-                message.append(
-                    [
-                        {'role': 'system', 'content': f'Твоя задача — перефразировать в указанном стиле текст, который присылает пользователь. Не добавляй ничего от себя, даже кавычки.'},
-                        {'role': 'user', 'content': f'Текст: "{ln}"\nСтиль: {style}'}
-                    ]
-                )
-                # К сожалению, сложно оставить разделяющие строки
-                # чтобы сохранить структуру входного файла, поэтому
-                # они просто пропускаются.
-                continue
-        if not message:
+    # bytes и словари тоже итерируемы, но последовательностью строк не являются
+    elif isinstance(input, Iterable) and not isinstance(input, (bytes, bytearray, Mapping)):
+        # К сожалению, сложно оставить разделяющие строки
+        # чтобы сохранить структуру входного файла, поэтому
+        # они просто пропускаются.
+        lines = list(_iter_valid(input, len_limit))
+        if not lines:
             raise ValueError('Список запросов не должен быть пустым.')
-        answer = pipe(message, batch_size=16, max_new_tokens=token_limit)
-        answer = [ a[0]['generated_text'][-1]['content'] for a in answer ]
+
+        # Одинаковые строки отправляются модели один раз: для каждой
+        # уникальной строки хранятся позиции её копий в ответе
+        slots = {}
+        for i, ln in enumerate(lines):
+            slots.setdefault(ln, []).append(i)
+        message = [
+            [
+                SYSTEM_MESSAGE,
+                {'role': 'user', 'content': USER_PROMPT % (ln, style)}
+            ]
+            for ln in slots
+        ]
+
+        result = pipe.generate(message, token_limit)
+        answer = [None] * len(lines)
+        for idxs, a in zip(slots.values(), result):
+            for i in idxs:
+                answer[i] = a
 
     else:
-        raise TypeError('Аргумент input должен принимать строку или список строк.')
+        raise TypeError('Аргумент input должен принимать строку или последовательность строк.')
     
     return answer
 
 
+def run_style_transfer(pipe:TextEngine, text:str, style:str, token_limit:int|None=None, min_tokens:int|None=None, stop_when=None, finish_when=None) -> str:
+    """
+    Перефразирует целый текст (например, письмо) в указанном стиле одним запросом к модели.
+
+    Args:
+        pipe (TextEngine): Инициализированный движок, созданный функцией text_pipeline_init.
+        text (str): Текст для обработки.
+        style (str): Стиль, в котором необходимо перефразировать текст.
+        token_limit (int|None): Ограничение на количество выходных токенов модели.
+        min_tokens (int|None): Минимальное количество выходных токенов модели.
+        stop_when (Callable[[str], bool]|None): Условие досрочной остановки по уже сгенерированному тексту.
+        finish_when (Callable[[str], bool]|None): Условие, без выполнения которого модели запрещено завершать ответ.
+
+    Returns:
+        str: Перефразированный текст.
+
+    Raises:
+        ValueError: Если передан пустой текст.
+    """
+    text = text.strip()
+    if text == '':
+        raise ValueError('Входной текст не должен быть пустым или состоять только из пробелов.')
+    message = [
+        SYSTEM_MESSAGE,
+        {'role': 'user', 'content': USER_PROMPT % (text, style)}
+    ]
+    return pipe.generate([message], token_limit, min_tokens, stop_when, finish_when)[0].strip()
+
+
+def write_lines(path:str, lines:Iterable[str]):
+    """
+    Записывает строки в текстовый файл, завершая каждую переводом строки.
+
+    Args:
+        path (str): Путь к выходному файлу.
+        lines (Iterable[str]): Строки для записи.
+    """
+    with open(path, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
+        f.writelines(ln + '\n' for ln in lines)
+
+
+def write_text(path:str, text:str):
+    """
+    Записывает текст в текстовый файл.
+
+    Args:
+        path (str): Путь к выходному файлу.
+        text (str): Текст для записи.
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+# Движок процесса-обработчика при параллельной обработке (см. parallel_inference)
+_worker_pipe = None
+
+
+def _worker_init(device:str, lm:str, quantization:str|None):
+    # Процесс видит только свою видеокарту: переменная задаётся до первого обращения к CUDA
+    global _worker_pipe
+    os.environ['CUDA_VISIBLE_DEVICES'] = device
+    _worker_pipe = text_pipeline_init(lm, padding='left', quantization=quantization)
+
+
+def _worker_inference(style:str, lines:list[str], token_limit:int|None, len_limit:int|None) -> list[str]:
+    return inference(style, lines, _worker_pipe, token_limit, len_limit)
+
+
+def parallel_inference(style:str, input:Iterable[str], lm:str, workers:int, token_limit:int|None=None, len_limit:int|None=None, quantization:str|None=None) -> list[str]:
+    """
+    Перефразирует список строк, распределяя их между несколькими копиями модели.
+
+    Каждый процесс загружает свою копию модели на отдельную видеокарту и обрабатывает
+    свою часть строк, после чего ответы собираются в исходном порядке.
+
+    Args:
+        style (str): Стиль, в котором необходимо перефразировать текст.
+        input (Iterable[str]): Последовательность строк для обработки.
+        lm (str): Имя или путь к языковой модели.
+        workers (int): Количество процессов (видеокарт).
+        token_limit (int|None): Ограничение на количество выходных токенов модели.
+        len_limit (int|None): Максимальная длина одной входной строки.
+        quantization (str|None): Способ квантования весов (один из QUANTIZATION_METHODS).
+
+    Returns:
+        list[str]: Список перефразированных строк.
+
+    Raises:
+        TypeError: Если input не является последовательностью строк.
+        ValueError: Если функции передан пустой запрос.
+    """
+    # Строка, bytes и словари итерируемы, но последовательностью строк не являются
+    if not isinstance(input, Iterable) or isinstance(input, (str, bytes, bytearray, Mapping)):
+        raise TypeError('Аргумент input должен принимать последовательность строк.')
+    # Фильтрация совпадает с inference, чтобы ответы можно было сопоставить входным строкам
+    lines = list(_iter_valid(input, len_limit))
+    if not lines:
+        raise ValueError('Список запросов не должен быть пустым.')
+    # Повторяющиеся строки отбрасываются до распределения, чтобы не обрабатывать их в разных процессах
+    unique = list(dict.fromkeys(lines))
+    workers = min(workers, len(unique))
+
+    # spawn вместо fork: дочерние процессы не наследуют состояние CUDA родителя
+    ctx = multiprocessing.get_context('spawn')
+    shards = [ unique[rank::workers] for rank in range(workers) ]
+    # Номера карт берутся из маски родительского процесса (если она задана),
+    # иначе процессы попали бы на чужие физические видеокарты
+    visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if visible:
+        devices = [ d.strip() for d in visible.split(',') if d.strip() ]
+    else:
+        devices = [ str(rank) for rank in range(workers) ]
+    # На каждую видеокарту - свой процесс с явно заданным номером карты,
+    # поэтому rank-я часть строк гарантированно обрабатывается на rank-й карте
+    with contextlib.ExitStack() as stack:
+        futures = []
+        for rank, shard in enumerate(shards):
+            executor = stack.enter_context(ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=ctx,
+                initializer=_worker_init,
+                initargs=(devices[rank], lm, quantization)
+            ))
+            futures.append(executor.submit(_worker_inference, style, shard, token_limit, len_limit))
+        results = [ f.result() for f in futures ]
+
+    result = {}
+    for shard, shard_answer in zip(shards, results):
+        result.update(zip(shard, shard_answer))
+    return [ result[ln] for ln in lines ]
+
+
 # Привязка к конкретной модели вызвана отличающимся форматом данных у разных моделей (проверено).
 # При переключении модели может сломаться индексация контейнеров, из-за чего потребуется переписывать код.
 # Примечание: Qwen3, в отличии от Gemma, не является Gated моделью и не требует токена HuggingFace
@@ -128,16 +652,25 @@ def main():
     parser.add_argument('-r', '--realtime', action='store_true', help='Запуск в режиме реального времени.')
     parser.add_argument('-s', '--style', default=DEFAULT_STYLE, help=f'Выбор стиля, в котором будет переписан текст. По умолчанию - "{DEFAULT_STYLE}".')
     parser.add_argument('-t', '--tokens', default=MAX_OUTPUT_TOKENS, type=int, help=f'Лимит output-токенов на один запрос. По умолчанию - {MAX_OUTPUT_TOKENS}.')
+    # 'awq' недоступен: модель MODEL_NAME не является AWQ-чекпоинтом
+    parser.add_argument('-q', '--quantization', default=None, choices=[ m for m in QUANTIZATION_METHODS if m != 'awq' ], help='Квантование весов модели. По умолчанию отключено.')
+    parser.add_argument('-d', '--data-parallel', action='store_true', help='Обработка файла отдельной копией модели на каждой видеокарте.')
     args = parser.parse_args()
 
+    # При параллельной обработке файла модели загружаются в процессах-обработчиках
+    workers = torch.cuda.device_count() if args.data_parallel and not args.realtime else 1
+
     # Инициализация пайплайна модели
 
-    try:
-        pipe_instance = text_pipeline_init(MODEL_NAME, padding='left')
-        print('Модель успешно инициализирована.')
-    except Exception as e:
-        print(f'\033[31mПроизошла ошибка при инициализации модели:\n{e}\033[0m')
-        exit(1)
+    if workers <= 1:
+        # OSError - модель не найдена или не скачалась, ImportError - не установлена
+        # библиотека квантования, RuntimeError - ошибки CUDA (в том числе нехватка памяти)
+        try:
+            pipe_instance = text_pipeline_init(MODEL_NAME, padding='left', quantization=args.quantization, stream=args.realtime)
+            print('Модель успешно инициализирована.')
+        except (OSError, ImportError, RuntimeError, ValueError) as e:
+            print(f'\033[31mПроизошла ошибка при инициализации модели:\n{e}\033[0m')
+            exit(1)
 
     
     if args.realtime:
@@ -152,26 +685,41 @@ def main():
                 continue
             else:
                 try:
-                    answer = inference(args.style, text, pipe_instance, args.tokens, MAX_INPUT_LENGTH)
-                    print(answer + '\n')
-                except Exception as e:
+                    # Ответ печатается внутри inference по мере генерации
+                    inference(args.style, text, pipe_instance, args.tokens, MAX_INPUT_LENGTH, stream=True)
+                    print('\n')
+                except KeyboardInterrupt:
+                    # Ctrl+C прерывает только текущую генерацию
+                    print('\nГенерация прервана.\n')
+                except (TypeError, ValueError, torch.cuda.OutOfMemoryError) as e:
                     print(f'Ошибка обработки текста:\n{e}')
     else:
         # Режим обработки файла
         try:
+            # Файл читается построчно, без промежуточной строки со всем его содержимым
             with open(args.input_file, 'r', encoding='utf-8') as f:
-                lines = f.read().splitlines()
-
-            # Передача входных данных модели и получение ответа
-            answer = inference(args.style, lines, pipe_instance, args.tokens, MAX_INPUT_LENGTH)
-
-            with open(args.output, 'w', encoding='utf-8') as f:
-                f.write('\n'.join(answer))
-            
-        except FileNotFoundError as e:
+                lines = [ ln.rstrip('\n') for ln in f ]
+        except (OSError, UnicodeDecodeError) as e:
             print(f'\033[31mОшибка открытия файла:\n{e}\033[0m')
-        except Exception as e:
+            exit(1)
+
+        # Передача входных данных модели и получение ответа
+        try:
+            if workers > 1:
+                answer = parallel_inference(args.style, lines, MODEL_NAME, workers, args.tokens, MAX_INPUT_LENGTH, args.quantization)
+            else:
+                answer = inference(args.style, lines, pipe_instance, args.tokens, MAX_INPUT_LENGTH)
+        except (ValueError, torch.cuda.OutOfMemoryError, BrokenProcessPool) as e:
             print(f'\033[31mОшибка обработки файла:\n{e}\033[0m')
+            exit(1)
+
+        # При запуске через torchrun результат одинаков во всех процессах, файл пишет только первый
+        if int(os.environ.get('RANK', 0)) == 0:
+            try:
+                write_lines(args.output, answer)
+            except OSError as e:
+                print(f'\033[31mОшибка записи файла:\n{e}\033[0m')
+                exit(1)
 
 
 if __name__ == '__main__':
@@ -7,10 +7,41 @@ import genai_1_24 as tg
 
 MIN_WORDS = 100
 MAX_WORDS = 150
+# Примерное число токенов на одно слово текста на каждом из языков
+TOKENS_PER_WORD = {"ru": 1.6, "en": 1.3}
+_WORD_RE = re.compile(r"[A-Za-zА-Яа-яЁё0-9']+")
+_SENTENCE_END_RE = re.compile(r"[.!?]+")
 
 
 def count_words(text: str) -> int:
-    return len(re.findall(r"[A-Za-zА-Яа-яЁё0-9']+", text))
+    return len(_WORD_RE.findall(text))
+
+
+def letter_is_long_enough(text: str) -> bool:
+    # Пока письмо короче MIN_WORDS слов, модели нельзя его заканчивать
+    return count_words(text) >= MIN_WORDS
+
+
+def letter_is_complete(text: str) -> bool:
+    # Письмо можно заканчивать, когда набран минимальный объём и завершилось предложение,
+    # или когда превышен максимальный объём (лишнее отрезает trim_letter)
+    n = count_words(text)
+    return n > MAX_WORDS or n >= MIN_WORDS and text.rstrip().endswith((".", "!", "?"))
+
+
+def trim_letter(text: str) -> str:
+    # Обрезает текст по концу последнего предложения, укладывающегося в MAX_WORDS слов.
+    # Если такого нет, текст обрезается по MAX_WORDS-му слову.
+    if count_words(text) <= MAX_WORDS:
+        return text
+    cut = None
+    for m in _SENTENCE_END_RE.finditer(text):
+        if count_words(text[:m.end()]) > MAX_WORDS:
+            break
+        cut = m.end()
+    if cut is None:
+        cut = list(_WORD_RE.finditer(text))[MAX_WORDS - 1].end()
+    return text[:cut].rstrip()
 
 
 def detect_letter_type(letter_type_arg: str | None) -> str:
@@ -39,10 +70,28 @@ def generate_draft(pipe, prompt: str, max_new_tokens: int = 220) -> str:
         {"role": "system", "content": "Ты пишешь короткие письма. Соблюдай ограничения по объёму и теме."},
         {"role": "user", "content": prompt},
     ]
-    out = pipe(messages, max_new_tokens=max_new_tokens)[0]["generated_text"][-1]["content"].strip()
+    out = pipe.generate([messages], max_new_tokens)[0].strip()
     return out
 
 
+def expand_letter(pipe, draft: str, style: str, body: str, token_limit: int, min_tokens: int) -> str:
+    # Одна дополнительная просьба расширить слишком короткое письмо.
+    # Нужна для vLLM, где запрет на досрочное завершение (finish_when) не поддерживается.
+    messages = [
+        tg.SYSTEM_MESSAGE,
+        {"role": "user", "content": tg.USER_PROMPT % (draft.strip(), style)},
+        {"role": "assistant", "content": body},
+        {"role": "user", "content": "Сделай письмо чуть подробнее."},
+    ]
+    return pipe.generate(
+        [messages],
+        token_limit,
+        min_tokens,
+        stop_when=letter_is_complete,
+        finish_when=letter_is_long_enough,
+    )[0].strip()
+
+
 def format_final_letter(topic: str, body: str, signature: str, language: str = "ru") -> str:
     signature = signature.replace("\n", " ").strip()
     if language == "en":
@@ -58,28 +107,35 @@ def main():
     parser.add_argument("--lang", default="ru", choices=["ru", "en"], help="Язык письма")
     parser.add_argument("-o", "--output", default="output.txt", help="Файл .txt для сохранения")
     parser.add_argument("--model", default="Qwen/Qwen3-4B-Instruct-2507", help="Модель (как у одногруппника)")
+    parser.add_argument("--quantization", default=None, choices=tg.QUANTIZATION_METHODS, help="Квантование весов модели")
     args = parser.parse_args()
 
     letter_type = detect_letter_type(args.type)
 
-    pipe = tg.text_pipeline_init(args.model, padding="left")
+    pipe = tg.text_pipeline_init(args.model, padding="left", quantization=args.quantization)
 
     draft_prompt = build_draft_prompt(letter_type, args.topic, args.lang)
     draft = generate_draft(pipe, draft_prompt)
 
     style_for_tg = "official" if letter_type == "официальное" else "friendly"
-    body = tg.run_style_transfer(pipe, draft, style=style_for_tg)
-
-    tries = 6
-    for _ in range(tries):
-        w = count_words(body)
-        if MIN_WORDS <= w <= MAX_WORDS:
-            break
-        # если мало — попросим расширить; если много — сократить
-        if w < MIN_WORDS:
-            body = tg.run_style_transfer(pipe, body + "\n\nСделай письмо чуть подробнее.", style=style_for_tg)
-        else:
-            body = tg.run_style_transfer(pipe, body + "\n\nСократи письмо до 100–150 слов.", style=style_for_tg)
+    tokens_per_word = TOKENS_PER_WORD[args.lang]
+    # Объём 100–150 слов задаётся ограничениями генерации, поэтому обычно хватает одного прохода модели.
+    # Лимит токенов взят с запасом, чтобы модель успела закончить предложение, а превышение
+    # MAX_WORDS отрезается после генерации (vLLM не поддерживает stop_when, поэтому это нужно и там).
+    token_limit = int(MAX_WORDS * tokens_per_word * 1.2)
+    min_tokens = int(MIN_WORDS * tokens_per_word)
+    body = tg.run_style_transfer(
+        pipe,
+        draft,
+        style=style_for_tg,
+        token_limit=token_limit,
+        min_tokens=min_tokens,
+        stop_when=letter_is_complete,
+        finish_when=letter_is_long_enough,
+    )
+    if not letter_is_long_enough(body):
+        body = expand_letter(pipe, draft, style_for_tg, body, token_limit, min_tokens)
+    body = trim_letter(body)
 
     final_text = format_final_letter(args.topic, body, args.sign, args.lang)
 